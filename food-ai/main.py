@@ -1,8 +1,8 @@
 
 from fastapi import FastAPI
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Dict, Any, Optional, Tuple
-import os, json, re, pickle
+import os, sys, json, re, pickle, mmap, shutil, gzip, tempfile
 import random
 
 import numpy as np
@@ -27,6 +27,18 @@ RRF_K = int(os.getenv("RRF_K", "60"))
 HARD_MIN_KEEP = int(os.getenv("HARD_MIN_KEEP", "12"))
 DIVERSITY_LEVEL = int(os.getenv("DIVERSITY_LEVEL", "2"))
 
+# 쿼리 로그 샘플링 (오프라인 리플레이용, replay.py 참고) - 기본 꺼짐
+# Cloud Run 로컬 디스크는 메모리라서 켤 때는 QUERY_LOG_MAX_BYTES로 크기 제한
+QUERY_LOG_SAMPLE_RATE = float(os.getenv("QUERY_LOG_SAMPLE_RATE", "0"))
+QUERY_LOG_MAX = int(os.getenv("QUERY_LOG_MAX", "1000"))
+QUERY_LOG_FLUSH_N = int(os.getenv("QUERY_LOG_FLUSH_N", "100"))
+QUERY_LOG_FLUSH_SEC = float(os.getenv("QUERY_LOG_FLUSH_SEC", "30"))
+QUERY_LOG_MAX_BYTES = int(os.getenv("QUERY_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+QUERY_LOG_PATH = os.getenv(
+    "QUERY_LOG_PATH",
+    os.path.join(os.path.dirname(__file__), "logs", "query_log.jsonl"),
+)
+
 # =========================================================
 # 1) FastAPI
 # =========================================================
@@ -35,6 +47,7 @@ app = FastAPI(title="Recipe Recommender (BM25+FAISS+RuleRerank)")
 class ChatReq(BaseModel):
     message: str
     top_k: Optional[int] = 3
+    seed: Optional[int] = Field(None, ge=0, le=2**32 - 1)  # 지정하면 랜덤 선택이 재현 가능
 
 # =========================================================
 # 2) 유틸
@@ -152,22 +165,142 @@ def build_full_recipe_payload(r: Dict[str, Any]) -> Dict[str, Any]:
 # =========================================================
 # 3) 아티팩트 로드
 # =========================================================
-def load_recipes_jsonl(path: str):
-    recipes = []
-    seq2idx = {}
-    seq2recipe = {}
-    with open(path, "r", encoding="utf-8") as f:
-        for idx, line in enumerate(f):
-            line = line.strip()
-            if not line:
-                continue
-            obj = json.loads(line)
-            recipes.append(obj)
-            seq = str(obj.get("RCP_SEQ", "")).strip()
-            if seq:
-                seq2idx[seq] = idx
-                seq2recipe[seq] = obj
-    return recipes, seq2idx, seq2recipe
+class RecipeStore:
+    """
+    recipes.jsonl을 mmap으로 열어두고 레시피별 바이트 오프셋만 보관
+    - 추천 점수 계산에 필요한 작은 피처만 컬럼으로 따로 들고 있음
+    - 전체 레시피(55개 필드)는 get()/get_by_seq() 호출 시에만 디코딩
+    """
+    __slots__ = (
+        "path", "_mm", "_starts", "_ends", "seq2idx",
+        "seq", "name", "pat", "way",
+        "is_soupish", "spicy_score", "greasy_score",
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+        starts: List[int] = []
+        ends: List[int] = []
+        self.seq2idx: Dict[str, int] = {}
+        self.seq: List[str] = []
+        self.name: List[str] = []
+        self.pat: List[str] = []
+        self.way: List[str] = []
+        soupish: List[int] = []
+        spicy: List[float] = []
+        greasy: List[float] = []
+
+        mm = self._mm
+        pos = 0
+        while pos < size:
+            end = mm.find(b"\n", pos)
+            if end < 0:
+                end = size
+            raw = mm[pos:end]
+            line = raw.strip()
+            if line:
+                obj = json.loads(line)
+                idx = len(starts)
+                # 앞뒤 공백/\r 제외한 위치 → raw()가 깨끗한 JSON 한 줄
+                lead = len(raw) - len(raw.lstrip())
+                starts.append(pos + lead)
+                ends.append(pos + lead + len(line))
+
+                seq = str(obj.get("RCP_SEQ", "")).strip()
+                if seq:
+                    self.seq2idx[seq] = idx
+                self.seq.append(seq)
+                self.name.append(obj.get("RCP_NM", ""))
+                # 카테고리/조리방법은 값 종류가 적어서 intern
+                self.pat.append(sys.intern(str(obj.get("RCP_PAT2", ""))))
+                self.way.append(sys.intern(str(obj.get("RCP_WAY2", ""))))
+                soupish.append(int(obj.get("is_soupish", 0) or 0))
+                spicy.append(float(obj.get("spicy_score", 0.0) or 0.0))
+                greasy.append(float(obj.get("greasy_score", 0.0) or 0.0))
+            pos = end + 1
+
+        self._starts = np.asarray(starts, dtype="int64")
+        self._ends = np.asarray(ends, dtype="int64")
+        self.is_soupish = np.asarray(soupish, dtype="int8")
+        self.spicy_score = np.asarray(spicy, dtype="float64")
+        self.greasy_score = np.asarray(greasy, dtype="float64")
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        return self.get(idx)
+
+    def raw(self, idx: int) -> bytes:
+        return self._mm[int(self._starts[idx]):int(self._ends[idx])]
+
+    def get(self, idx: int) -> Dict[str, Any]:
+        return json.loads(self.raw(idx))
+
+    def get_by_seq(self, seq: str) -> Optional[Dict[str, Any]]:
+        idx = self.seq2idx.get(seq)
+        if idx is None:
+            return None
+        return self.get(idx)
+
+    def candidate(self, idx: int, score: float) -> Dict[str, Any]:
+        """
+        후보 dict (재정렬/필터/다양성 단계에서 쓰는 필드만)
+        """
+        return {
+            "RCP_SEQ": self.seq[idx],
+            "RCP_NM": self.name[idx],
+            "RCP_PAT2": self.pat[idx],
+            "RCP_WAY2": self.way[idx],
+            "is_soupish": int(self.is_soupish[idx]),
+            "spicy_score": float(self.spicy_score[idx]),
+            "greasy_score": float(self.greasy_score[idx]),
+            "_mix_score": float(score),
+        }
+
+def load_recipes_jsonl(path: str) -> RecipeStore:
+    return RecipeStore(path)
+
+# 전체 파일 다운로드용 사전 압축본 (Accept-Encoding 협상으로 서빙)
+# 이미지 빌드 시 생성 (Dockerfile 참고) → 런타임 로딩은 읽기 전용
+PRECOMPRESSED = [("zstd", ".zst"), ("gzip", ".gz")]
+
+def _compress_file(src: str, dst: str, encoding: str):
+    # 프로세스별 임시파일에 쓰고 교체 → 동시에 돌아도 반쯤 쓴 파일이 안 보임
+    tmp = tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(dst) or ".", prefix=os.path.basename(dst) + ".", suffix=".tmp", delete=False
+    )
+    try:
+        with tmp, open(src, "rb") as fin:
+            if encoding == "gzip":
+                # mtime=0 → 같은 원본이면 같은 결과, 헤더 파일명은 원본 이름
+                with gzip.GzipFile(filename=os.path.basename(src), mode="wb",
+                                   compresslevel=9, fileobj=tmp, mtime=0) as fout:
+                    shutil.copyfileobj(fin, fout, 1 << 20)
+            else:
+                import zstandard
+                zstandard.ZstdCompressor(level=19).copy_stream(fin, tmp)
+        os.replace(tmp.name, dst)
+    except BaseException:
+        if os.path.exists(tmp.name):
+            os.remove(tmp.name)
+        raise
+
+def build_precompressed(path: str):
+    """
+    path.gz / path.zst 가 없거나 원본보다 오래됐으면 다시 만듦
+    """
+    src_mtime = os.path.getmtime(path)
+    for encoding, ext in PRECOMPRESSED:
+        dst = path + ext
+        if os.path.exists(dst) and os.path.getmtime(dst) >= src_mtime:
+            continue
+        _compress_file(path, dst, encoding)
+        print(f"precompressed {encoding}:", dst, flush=True)
 
 import threading
 from fastapi import HTTPException
@@ -181,7 +314,6 @@ state = {
     "finished_at": None,
     "RECIPES": None,
     "SEQ2IDX": None,
-    "SEQ2RECIPE": None,
     "TOKENIZED": None,
     "BM25": None,
     "FAISS_INDEX": None,
@@ -221,7 +353,8 @@ def load_all_artifacts():
 
         # ✅ recipes
         state["step"] = "load_recipes"
-        RECIPES, SEQ2IDX, SEQ2RECIPE = load_recipes_jsonl(RECIPES_PATH)
+        RECIPES = load_recipes_jsonl(RECIPES_PATH)
+        SEQ2IDX = RECIPES.seq2idx
         print("recipes 수:", len(RECIPES), flush=True)
 
         # ✅ tokenized
@@ -252,7 +385,6 @@ def load_all_artifacts():
         state.update({
             "RECIPES": RECIPES,
             "SEQ2IDX": SEQ2IDX,
-            "SEQ2RECIPE": SEQ2RECIPE,
             "TOKENIZED": TOKENIZED,
             "BM25": BM25,
             "FAISS_INDEX": FAISS_INDEX,
@@ -341,24 +473,9 @@ def rrf_mix_candidates(query: str, top_n: int, pull_n: int, k: int = 60) -> List
     # ✅ FAISS 비활성 or 로딩 안 됨 → BM25만 사용
     if (not USE_FAISS) or (state.get("FAISS_INDEX") is None) or (state.get("EMBED_MODEL") is None):
         a.sort(key=lambda x: x[1], reverse=True)
-        out = []
         RECIPES = state["RECIPES"]
-        for idx, score in a[:top_n]:
-            r = RECIPES[idx]
-            out.append({
-                "RCP_SEQ": str(r.get("RCP_SEQ", "")).strip(),
-                "RCP_NM": r.get("RCP_NM", ""),
-                "RCP_PAT2": r.get("RCP_PAT2", ""),
-                "RCP_WAY2": r.get("RCP_WAY2", ""),
-                "HASH_TAG": r.get("HASH_TAG", ""),
-                "RCP_PARTS_DTLS": r.get("RCP_PARTS_DTLS", ""),
-                "auto_tags": r.get("auto_tags", []),
-                "is_soupish": r.get("is_soupish", 0),
-                "spicy_score": float(r.get("spicy_score", 0.0) or 0.0),
-                "greasy_score": float(r.get("greasy_score", 0.0) or 0.0),
-                "_mix_score": float(score),  # ✅ BM25 점수로 대체
-            })
-        return out
+        # ✅ _mix_score는 BM25 점수로 대체
+        return [RECIPES.candidate(idx, score) for idx, score in a[:top_n]]
 
     # ✅ FAISS까지 정상 로딩된 경우만 RRF 수행
     b = faiss_candidates(query, pull_n)
@@ -378,33 +495,26 @@ def rrf_mix_candidates(query: str, top_n: int, pull_n: int, k: int = 60) -> List
 
     scored.sort(key=lambda x: x[1], reverse=True)
 
-    out = []
     RECIPES = state["RECIPES"]
-    for idx, score in scored[:top_n]:
-        r = RECIPES[idx]
-        out.append({
-            "RCP_SEQ": str(r.get("RCP_SEQ", "")).strip(),
-            "RCP_NM": r.get("RCP_NM", ""),
-            "RCP_PAT2": r.get("RCP_PAT2", ""),
-            "RCP_WAY2": r.get("RCP_WAY2", ""),
-            "HASH_TAG": r.get("HASH_TAG", ""),
-            "RCP_PARTS_DTLS": r.get("RCP_PARTS_DTLS", ""),
-            "auto_tags": r.get("auto_tags", []),
-            "is_soupish": r.get("is_soupish", 0),
-            "spicy_score": float(r.get("spicy_score", 0.0) or 0.0),
-            "greasy_score": float(r.get("greasy_score", 0.0) or 0.0),
-            "_mix_score": float(score),
-        })
-    return out
+    return [RECIPES.candidate(idx, score) for idx, score in scored[:top_n]]
 
 # =========================================================
 # 6) 의도 기반 재정렬 + (조건부) 하드 필터
 # =========================================================
+# 재정렬/필터/추천 이유에서 쓰는 키워드 (replay.py 설정으로 덮어쓸 수 있음)
+SOUP_PAT_KW      = ["국", "탕", "찌개", "전골"]
+SPICY_NAME_KW    = ["김치", "매운", "매콤", "얼큰", "마라", "불닭"]
+SPICY_FILTER_KW  = ["매운", "매콤", "얼큰", "마라", "불닭", "김치", "고추", "청양"]
+GREASY_FILTER_KW = ["크림", "치즈", "버터", "로제", "까르보", "알프레도", "튀김"]
+GREASY_REASON_KW = ["크림", "치즈", "로제", "까르보", "알프레도", "튀김"]
+GREASY_BAD_KW    = ["나물", "겉절이", "샐러드", "냉국"]
+SALAD_NAME_KW    = ["샐러드", "채소", "야채"]
+
 def apply_intent_rerank(cands: List[Dict[str, Any]], intent: Dict[str, int]) -> List[Dict[str, Any]]:
     def bad_for_greasy(c):
         name = str(c.get("RCP_NM", ""))
         pat = str(c.get("RCP_PAT2", ""))
-        return any(k in name for k in ["나물", "겉절이", "샐러드", "냉국"]) or ("샐러드" in pat)
+        return any(k in name for k in GREASY_BAD_KW) or ("샐러드" in pat)
 
     def score_boost(c):
         s = float(c.get("_mix_score", 0.0))
@@ -412,7 +522,7 @@ def apply_intent_rerank(cands: List[Dict[str, Any]], intent: Dict[str, int]) ->
         if intent["want_soup"]:
             if int(c.get("is_soupish", 0)) == 1:
                 s += 0.25
-            if any(k in str(c.get("RCP_PAT2","")) for k in ["국", "탕", "찌개", "전골"]):
+            if any(k in str(c.get("RCP_PAT2","")) for k in SOUP_PAT_KW):
                 s += 0.12
 
         if intent["want_greasy"]:
@@ -423,12 +533,12 @@ def apply_intent_rerank(cands: List[Dict[str, Any]], intent: Dict[str, int]) ->
         if intent["want_spicy"]:
             s += 0.28 * float(c.get("spicy_score", 0.0))
             nm = str(c.get("RCP_NM",""))
-            if any(k in nm for k in ["김치", "매운", "매콤", "얼큰", "마라", "불닭"]):
+            if any(k in nm for k in SPICY_NAME_KW):
                 s += 0.08
 
         if intent["want_salad"]:
             name = str(c.get("RCP_NM",""))
-            if any(k in name for k in ["샐러드", "채소", "야채"]):
+            if any(k in name for k in SALAD_NAME_KW):
                 s += 0.25
             else:
                 s -= 0.08
@@ -451,7 +561,7 @@ def hard_filter_if_possible(cands: List[Dict[str, Any]], intent: Dict[str, int],
         tmp = [
             c for c in out
             if int(c.get("is_soupish", 0)) == 1
-            or any(k in str(c.get("RCP_PAT2","")) for k in ["국","탕","찌개","전골"])
+            or any(k in str(c.get("RCP_PAT2","")) for k in SOUP_PAT_KW)
         ]
         if len(tmp) >= min_keep:
             out = tmp
@@ -460,7 +570,7 @@ def hard_filter_if_possible(cands: List[Dict[str, Any]], intent: Dict[str, int],
         tmp = [
             c for c in out
             if float(c.get("spicy_score", 0.0)) >= 0.25
-            or any(k in str(c.get("RCP_NM","")) for k in ["매운","매콤","얼큰","마라","불닭","김치","고추","청양"])
+            or any(k in str(c.get("RCP_NM","")) for k in SPICY_FILTER_KW)
         ]
         if len(tmp) >= min_keep:
             out = tmp
@@ -468,7 +578,7 @@ def hard_filter_if_possible(cands: List[Dict[str, Any]], intent: Dict[str, int],
     if intent["want_salad"]:
         tmp = [
             c for c in out
-            if any(k in str(c.get("RCP_NM","")) for k in ["샐러드","채소","야채"])
+            if any(k in str(c.get("RCP_NM","")) for k in SALAD_NAME_KW)
             or "샐러드" in str(c.get("RCP_PAT2",""))
         ]
         if len(tmp) >= min_keep:
@@ -478,7 +588,7 @@ def hard_filter_if_possible(cands: List[Dict[str, Any]], intent: Dict[str, int],
         tmp = [
             c for c in out
             if float(c.get("greasy_score", 0.0)) >= 0.20
-            or any(k in str(c.get("RCP_NM","")) for k in ["크림","치즈","버터","로제","까르보","알프레도","튀김"])
+            or any(k in str(c.get("RCP_NM","")) for k in GREASY_FILTER_KW)
         ]
         if len(tmp) >= min_keep:
             out = tmp
@@ -550,13 +660,13 @@ def pick_reason(intent: Dict[str, int], c: Dict[str, Any]) -> str:
 
     rs = []
     if intent["want_soup"]:
-        if soupish == 1 or any(k in pat for k in ["국","탕","찌개","전골"]):
+        if soupish == 1 or any(k in pat for k in SOUP_PAT_KW):
             rs.append("국물/탕·찌개 계열")
     if intent["want_spicy"]:
-        if spicy >= 0.25 or any(k in nm for k in ["김치","매운","매콤","얼큰","마라","불닭"]):
+        if spicy >= 0.25 or any(k in nm for k in SPICY_NAME_KW):
             rs.append("얼큰/매콤 포인트")
     if intent["want_greasy"]:
-        if greasy >= 0.20 or any(k in nm for k in ["크림","치즈","로제","까르보","알프레도","튀김"]):
+        if greasy >= 0.20 or any(k in nm for k in GREASY_REASON_KW):
             rs.append("고소/크리미 포인트")
 
     if not rs:
@@ -566,13 +676,17 @@ def pick_reason(intent: Dict[str, int], c: Dict[str, Any]) -> str:
             rs.append("후보 점수 상위")
     return ", ".join(rs[:2])
 
-def weighted_random_pick(cands: List[Dict[str, Any]], k: int, pool: int = 30, temp: float = 0.9) -> List[Dict[str, Any]]:
+def weighted_random_pick(cands: List[Dict[str, Any]], k: int, pool: int = 30, temp: float = 0.9,
+                         rng: Optional[np.random.RandomState] = None) -> List[Dict[str, Any]]:
     """
     cands: 점수 내림차순 후보(이미 tuned된 상태)
     k: 최종 추천 개수
     pool: 상위 몇 개 후보에서 랜덤하게 뽑을지
     temp: 낮을수록 상위가 더 자주 뽑힘(0.7~1.2 추천)
+    rng: 시드 고정용 RandomState (없으면 전역 np.random 사용)
     """
+    if rng is None:
+        rng = np.random
     pool_cands = cands[:max(pool, k)]
     if not pool_cands:
         return []
@@ -582,8 +696,8 @@ def weighted_random_pick(cands: List[Dict[str, Any]], k: int, pool: int = 30, te
 
     # 모두 0이거나 음수면 균등 랜덤
     if np.all(scores <= 0):
-        random.shuffle(pool_cands)
-        return pool_cands[:k]
+        order = rng.permutation(len(pool_cands))
+        return [pool_cands[i] for i in order[:k]]
 
     # 안정적으로 양수화 + temperature 적용
     scores = scores - scores.min() + 1e-6
@@ -598,24 +712,273 @@ def weighted_random_pick(cands: List[Dict[str, Any]], k: int, pool: int = 30, te
             break
         w = weights[idxs]
         w = w / w.sum()
-        chosen = np.random.choice(idxs, p=w)
+        chosen = int(rng.choice(idxs, p=w))
         used.add(chosen)
         picked.append(pool_cands[chosen])
 
     return picked
 
 # =========================================================
-# 9) 엔드포인트
+# 9) 추천 파이프라인 (엔드포인트 / replay.py 공용)
+# =========================================================
+def recommend(user_query: str, top_k: int, seed: int,
+              cand_pull: Optional[int] = None, cand_top_n: Optional[int] = None,
+              rrf_k: Optional[int] = None, hard_min_keep: Optional[int] = None,
+              diversity_level: Optional[int] = None) -> Dict[str, Any]:
+    """
+    user_query: norm_text 처리된 질의
+    설정값을 넘기지 않으면 모듈 전역값(CAND_PULL 등) 사용
+    반환: intent, ranking(랜덤 선택 전 결정적 순위의 RCP_SEQ), picks(최종 후보), timings(단계별 ms)
+    """
+    cand_pull = CAND_PULL if cand_pull is None else cand_pull
+    cand_top_n = CAND_TOP_N if cand_top_n is None else cand_top_n
+    rrf_k = RRF_K if rrf_k is None else rrf_k
+    hard_min_keep = HARD_MIN_KEEP if hard_min_keep is None else hard_min_keep
+    diversity_level = DIVERSITY_LEVEL if diversity_level is None else diversity_level
+
+    timings: Dict[str, float] = {}
+    t0 = time.perf_counter()
+
+    def lap(name: str):
+        nonlocal t0
+        t1 = time.perf_counter()
+        timings[name] = round((t1 - t0) * 1000.0, 3)
+        t0 = t1
+
+    intent = parse_intent(user_query)
+    lap("intent")
+
+    base_cands = rrf_mix_candidates(user_query, top_n=cand_pull, pull_n=cand_pull, k=rrf_k)
+    lap("retrieve")
+    if not base_cands:
+        return {"intent": intent, "ranking": [], "picks": [], "timings": timings}
+
+    tuned = apply_intent_rerank(base_cands, intent)
+    lap("rerank")
+    tuned = hard_filter_if_possible(tuned, intent, min_keep=hard_min_keep)
+    lap("filter")
+
+    candidates = tuned[:cand_top_n]
+    ranking = [str(c.get("RCP_SEQ","")).strip() for c in candidates]
+    rng = np.random.RandomState(seed)
+    rand_picks = weighted_random_pick(candidates, k=top_k, pool=30, temp=0.9, rng=rng)
+    final_picks = diversify_pick(rand_picks, top_k=top_k, level=diversity_level)
+    lap("pick")
+
+    return {"intent": intent, "ranking": ranking, "picks": final_picks, "timings": timings}
+
+# =========================================================
+# 10) 쿼리 로그 샘플링 (메모리 링버퍼 → JSONL)
+# =========================================================
+from collections import deque
+
+QUERY_LOG = deque(maxlen=max(1, QUERY_LOG_MAX))  # 가득 차면 오래된 샘플부터 버림
+QUERY_LOG_LOCK = threading.Lock()
+QUERY_LOG_FLUSH_LOCK = threading.Lock()
+QUERY_LOG_WAKE = threading.Event()
+QUERY_LOG_STOP = threading.Event()
+
+def _rotate_query_log():
+    # 파일이 QUERY_LOG_MAX_BYTES를 넘으면 .1 로 한 번만 보관 (최대 2배 크기)
+    try:
+        if os.path.getsize(QUERY_LOG_PATH) >= QUERY_LOG_MAX_BYTES:
+            os.replace(QUERY_LOG_PATH, QUERY_LOG_PATH + ".1")
+    except FileNotFoundError:
+        pass
+
+def flush_query_log() -> int:
+    """
+    버퍼에 쌓인 샘플을 QUERY_LOG_PATH에 append
+    실패하면 샘플을 버퍼에 되돌림 (넘치면 오래된 것부터 버림)
+    반환: 기록한 줄 수
+    """
+    with QUERY_LOG_FLUSH_LOCK:
+        with QUERY_LOG_LOCK:
+            rows = list(QUERY_LOG)
+            QUERY_LOG.clear()
+        if not rows:
+            return 0
+        try:
+            os.makedirs(os.path.dirname(QUERY_LOG_PATH) or ".", exist_ok=True)
+            _rotate_query_log()
+            with open(QUERY_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+        except Exception as e:
+            with QUERY_LOG_LOCK:
+                pending = rows + list(QUERY_LOG)
+                QUERY_LOG.clear()
+                QUERY_LOG.extend(pending)
+            print("⚠️ 쿼리 로그 flush 실패:", f"{type(e).__name__}: {e}", flush=True)
+            return 0
+        return len(rows)
+
+def _query_log_flusher():
+    # 요청 스레드 대신 여기서 파일 I/O (FLUSH_N개 쌓이거나 FLUSH_SEC마다)
+    while not QUERY_LOG_STOP.is_set():
+        QUERY_LOG_WAKE.wait(QUERY_LOG_FLUSH_SEC)
+        QUERY_LOG_WAKE.clear()
+        flush_query_log()
+
+def log_query_sample(row: Dict[str, Any]):
+    if QUERY_LOG_SAMPLE_RATE <= 0 or random.random() >= QUERY_LOG_SAMPLE_RATE:
+        return
+    with QUERY_LOG_LOCK:
+        QUERY_LOG.append(row)
+        n = len(QUERY_LOG)
+    if n >= QUERY_LOG_FLUSH_N:
+        QUERY_LOG_WAKE.set()
+
+@app.on_event("startup")
+def start_query_log_flusher():
+    if QUERY_LOG_SAMPLE_RATE > 0:
+        QUERY_LOG_STOP.clear()
+        threading.Thread(target=_query_log_flusher, name="query-log-flusher", daemon=True).start()
+
+@app.on_event("shutdown")
+def shutdown():
+    QUERY_LOG_STOP.set()
+    QUERY_LOG_WAKE.set()
+    flush_query_log()
+
+# =========================================================
+# 11) 엔드포인트
 # =========================================================
-from fastapi.responses import FileResponse
+from fastapi import Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+EXPORT_FIELDS = set(build_full_recipe_payload({})) - {"MANUAL_STEPS"}
+
+def split_csv(v: Optional[str]) -> List[str]:
+    if not v:
+        return []
+    return [x.strip() for x in v.split(",") if x.strip()]
+
+def parse_since(v: str) -> float:
+    """
+    updated_since: epoch 초 또는 ISO8601 / HTTP 날짜
+    """
+    v = v.strip()
+    try:
+        return float(v)
+    except ValueError:
+        pass
+    try:
+        dt = datetime.fromisoformat(v.replace("Z", "+00:00"))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.timestamp()
+    except ValueError:
+        pass
+    try:
+        return parsedate_to_datetime(v).timestamp()
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail=f"updated_since 형식 오류: {v}")
+
+def accepted_encodings(header: str) -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for part in header.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, params = part.partition(";")
+        q = 1.0
+        for p in params.split(";"):
+            k, _, val = p.strip().partition("=")
+            if k == "q":
+                try:
+                    q = float(val)
+                except ValueError:
+                    q = 0.0
+        out[name.strip().lower()] = q
+    return out
+
+def pick_variant(path: str, accept_encoding: str) -> Tuple[str, Optional[str]]:
+    """
+    Accept-Encoding에 맞는 사전 압축본 선택 (zstd > gzip > 원본)
+    """
+    acc = accepted_encodings(accept_encoding or "")
+    for encoding, ext in PRECOMPRESSED:
+        q = acc[encoding] if encoding in acc else acc.get("*", 0.0)
+        if q > 0 and os.path.exists(path + ext):
+            return path + ext, encoding
+    return path, None
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+def iter_export(store: RecipeStore, fields: List[str], pats: set, ways: set):
+    """
+    레시피를 하나씩 NDJSON 줄로 생성 (메모리 사용량은 코퍼스 크기와 무관)
+    """
+    for idx in range(len(store)):
+        if pats and store.pat[idx] not in pats:
+            continue
+        if ways and store.way[idx] not in ways:
+            continue
+        if not fields:
+            yield store.raw(idx) + b"\n"
+            continue
+        r = store.get(idx)
+        row = {k: r.get(k, "") for k in fields}
+        yield (json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8")
 
 @app.get("/recipes.jsonl")
-def download_recipes_jsonl():
+def download_recipes_jsonl(
+    request: Request,
+    fields: Optional[str] = None,
+    pat2: Optional[str] = None,
+    way2: Optional[str] = None,
+    updated_since: Optional[str] = None,
+):
+    """
+    - 파라미터 없음: 전체 파일 (gzip/zstd 협상, Range, ETag/If-None-Match 지원)
+    - fields=RCP_SEQ,RCP_NM / pat2=반찬,국%26찌개 / way2=끓이기: 필터된 NDJSON 스트리밍
+      ('국&찌개'처럼 &가 들어간 값은 %26으로 인코딩해야 함)
+    - updated_since: 레시피별 수정시각이 없어서 스냅샷(recipes.jsonl) 수정시각 기준.
+      그 이후 변경이 없으면 빈 응답. 다음 호출용 커서는 X-Export-Cursor 헤더로 전달
+    """
     must_exist(RECIPES_PATH, "recipes.jsonl")
+    snapshot_mtime = os.path.getmtime(RECIPES_PATH)
+    cursor = {"X-Export-Cursor": repr(snapshot_mtime)}
+
+    field_list = split_csv(fields)
+    unknown = [f for f in field_list if f not in EXPORT_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"알 수 없는 필드: {unknown}")
+    pats = set(split_csv(pat2))
+    ways = set(split_csv(way2))
+
+    if updated_since is not None and snapshot_mtime <= parse_since(updated_since):
+        return Response(content=b"", media_type="application/x-ndjson", headers=cursor)
+
+    if field_list or pats or ways:
+        ensure_ready()
+        return StreamingResponse(
+            iter_export(state["RECIPES"], field_list, pats, ways),
+            media_type="application/x-ndjson",
+            headers=cursor,
+        )
+
+    path, encoding = pick_variant(RECIPES_PATH, request.headers.get("accept-encoding", ""))
+    st = os.stat(path)
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}{"-" + encoding if encoding else ""}"'
+    headers = {**cursor, "ETag": etag, "Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+
+    inm = request.headers.get("if-none-match")
+    if inm and etag_matches(inm, etag):
+        return Response(status_code=304, headers=headers)
+
     return FileResponse(
-        RECIPES_PATH,
+        path,
         media_type="application/json",
         filename="recipes.jsonl",
+        headers=headers,
+        stat_result=st,
     )
 
 @app.get("/health")
@@ -644,25 +1007,38 @@ def chat(req: ChatReq):
     if not user_query:
         return {"reply": "요청이 비어 있어요.", "foods": []}
 
-    intent = parse_intent(user_query)
+    seed = req.seed if req.seed is not None else random.getrandbits(32)
+    t_start = time.perf_counter()
+    res = recommend(user_query, top_k=top_k, seed=seed)
+    intent = res["intent"]
+    final_picks = res["picks"]
+    timings = res["timings"]
+
+    def log_sample():
+        total_ms = (time.perf_counter() - t_start) * 1000.0
+        pipeline_ms = sum(timings.values())
+        timings["build"] = round(total_ms - pipeline_ms, 3)
+        timings["pipeline_total"] = round(pipeline_ms, 3)  # build 제외 (replay.py와 비교용)
+        timings["total"] = round(total_ms, 3)
+        log_query_sample({
+            "ts": time.time(),
+            "query": user_query,
+            "intent": intent,
+            "top_k": top_k,
+            "seed": seed,
+            "timings_ms": timings,
+            "ranking": res["ranking"],
+            "seqs": [str(c.get("RCP_SEQ","")).strip() for c in final_picks],
+        })
 
-    base_cands = rrf_mix_candidates(user_query, top_n=CAND_PULL, pull_n=CAND_PULL, k=RRF_K)
-    if not base_cands:
+    if not final_picks:
+        log_sample()  # 결과 0건 쿼리도 리플레이 대상
         return {"reply": "추천할 후보를 찾지 못했어요.", "foods": []}
 
-    tuned = apply_intent_rerank(base_cands, intent)
-    tuned = hard_filter_if_possible(tuned, intent, min_keep=HARD_MIN_KEEP)
-
-    candidates = tuned[:CAND_TOP_N]
-    rand_picks = weighted_random_pick(candidates, k=top_k, pool=30, temp=0.9)
-    final_picks = diversify_pick(rand_picks, top_k=top_k, level=DIVERSITY_LEVEL)
-
-
     foods = []
     for c in final_picks:
         seq = str(c.get("RCP_SEQ","")).strip()
-        SEQ2RECIPE = state["SEQ2RECIPE"]
-        r = SEQ2RECIPE.get(seq)
+        r = state["RECIPES"].get_by_seq(seq)
 
         if not r:
             continue
@@ -677,6 +1053,8 @@ def chat(req: ChatReq):
             "reason": pick_reason(intent, c),
         })
 
+    log_sample()
+
     if not foods:
         return {"reply": "후보는 찾았는데 결과 매핑에 실패했어요.", "foods": []}
 
@@ -693,7 +1071,7 @@ def get_recipe_by_seq(seq: str):
     if not seq:
         raise HTTPException(status_code=400, detail="seq 필요")
 
-    r = state["SEQ2RECIPE"].get(seq)
+    r = state["RECIPES"].get_by_seq(seq)
     if not r:
         raise HTTPException(status_code=404, detail="해당 SEQ 레시피 없음")
 
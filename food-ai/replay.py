@@ -0,0 +1,259 @@
+"""
+쿼리 로그 리플레이 도구
+
+/chat 에서 샘플링된 쿼리 로그(QUERY_LOG_PATH, JSONL)를 지정한 아티팩트/설정으로
+다시 돌려서 단계별 지연시간 분포와 랭킹 차이(overlap@k, RBO)를 출력한다.
+
+랭킹 차이는 랜덤 선택 전 결정적 순위(hard filter 후 상위 CAND_TOP_N, 로그의 ranking)
+기준이다. 실제 응답(seqs, 가중 랜덤 선택 결과)은 보조 지표(served)로 따로 출력한다.
+
+예)
+  python replay.py --log logs/query_log.jsonl
+  python replay.py --log logs/query_log.jsonl --config a.json --compare b.json --k 5
+  python replay.py --log logs/query_log.jsonl --artifacts /path/to/snapshot --json
+
+설정 파일(JSON)에 넣을 수 있는 키:
+  CAND_PULL, CAND_TOP_N, RRF_K, HARD_MIN_KEEP, DIVERSITY_LEVEL,
+  GREASY_HINT, SOUP_HINT, SPICY_HINT, SALAD_HINT              (의도 추출)
+  SOUP_PAT_KW, SPICY_NAME_KW, SPICY_FILTER_KW, GREASY_FILTER_KW,
+  GREASY_REASON_KW, GREASY_BAD_KW, SALAD_NAME_KW               (재정렬/필터)
+--compare 가 없으면 로그에 기록된 ranking / seqs 와 비교한다.
+지연시간은 build(응답 payload 생성)를 뺀 pipeline_total 기준으로 비교한다.
+"""
+import argparse
+import json
+import os
+import sys
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+import main
+
+CONFIG_KEYS = ["CAND_PULL", "CAND_TOP_N", "RRF_K", "HARD_MIN_KEEP", "DIVERSITY_LEVEL"]
+KEYWORD_KEYS = [
+    "GREASY_HINT", "SOUP_HINT", "SPICY_HINT", "SALAD_HINT",
+    "SOUP_PAT_KW", "SPICY_NAME_KW", "SPICY_FILTER_KW", "GREASY_FILTER_KW",
+    "GREASY_REASON_KW", "GREASY_BAD_KW", "SALAD_NAME_KW",
+]
+STAGES = ["intent", "retrieve", "rerank", "filter", "pick", "pipeline_total"]
+
+# =========================================================
+# 1) 입력 로드
+# =========================================================
+def load_query_log(path: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    rows = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            rows.append(json.loads(line))
+            if limit and len(rows) >= limit:
+                break
+    return rows
+
+def load_config(path: Optional[str]) -> Dict[str, Any]:
+    if not path:
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        cfg = json.load(f)
+    unknown = set(cfg) - set(CONFIG_KEYS) - set(KEYWORD_KEYS)
+    if unknown:
+        raise ValueError(f"알 수 없는 설정 키: {sorted(unknown)}")
+    return cfg
+
+def load_artifacts(art_dir: Optional[str]):
+    if art_dir:
+        main.ART_DIR = art_dir
+        main.RECIPES_PATH = os.path.join(art_dir, "recipes.jsonl")
+        main.TOKENIZED_PATH = os.path.join(art_dir, "tokenized.pkl")
+        main.FAISS_PATH = os.path.join(art_dir, "faiss.index")
+        main.META_PATH = os.path.join(art_dir, "meta.pkl")
+    main.load_all_artifacts()
+    if not main.state["ready"]:
+        raise RuntimeError(f"아티팩트 로딩 실패: {main.state['error']}")
+
+# =========================================================
+# 2) 리플레이
+# =========================================================
+def replay(rows: List[Dict[str, Any]], cfg: Dict[str, Any], k: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    rows의 각 쿼리를 같은 seed로 다시 실행
+    k: 지정하면 로그의 top_k 대신 이 개수만큼 뽑음 (served 결과)
+    """
+    saved = {key: getattr(main, key) for key in KEYWORD_KEYS}
+    kwargs = {key.lower(): int(cfg[key]) for key in CONFIG_KEYS if key in cfg}
+    try:
+        for key in KEYWORD_KEYS:
+            if key in cfg:
+                setattr(main, key, list(cfg[key]))
+
+        out = []
+        for row in rows:
+            query = main.norm_text(row.get("query"))
+            top_k = int(k or row.get("top_k") or 3)
+            seed = int(row.get("seed") or 0)
+            res = main.recommend(query, top_k=top_k, seed=seed, **kwargs)
+            timings = dict(res["timings"])
+            timings["pipeline_total"] = round(sum(timings.values()), 3)
+            out.append({
+                "query": query,
+                "ranking": res["ranking"],
+                "seqs": [str(c.get("RCP_SEQ", "")).strip() for c in res["picks"]],
+                "timings_ms": timings,
+            })
+        return out
+    finally:
+        for key, v in saved.items():
+            setattr(main, key, v)
+
+# =========================================================
+# 3) 지표
+# =========================================================
+def overlap_at_k(a: List[str], b: List[str], k: int) -> float:
+    """
+    k보다 적게 나온 경우는 실제 길이 기준 (둘 다 비어 있으면 1.0)
+    """
+    depth = min(k, max(len(a[:k]), len(b[:k])))
+    if depth <= 0:
+        return 1.0
+    return len(set(a[:k]) & set(b[:k])) / float(depth)
+
+def rank_biased_overlap(a: List[str], b: List[str], p: float = 0.9) -> float:
+    """
+    RBO_ext (Webber et al., 2010) - 두 리스트를 짧은 쪽 길이로 맞춰 계산
+    동일하면 1.0, 전혀 겹치지 않으면 0.0
+    """
+    depth = min(len(a), len(b))
+    if depth == 0:
+        return 1.0 if len(a) == len(b) else 0.0
+
+    seen_a, seen_b = set(), set()
+    overlap = 0
+    acc = 0.0
+    for d in range(1, depth + 1):
+        x, y = a[d - 1], b[d - 1]
+        if x == y:
+            overlap += 1
+        else:
+            overlap += (x in seen_b) + (y in seen_a)
+        seen_a.add(x)
+        seen_b.add(y)
+        acc += (overlap / d) * (p ** d)
+    return (overlap / depth) * (p ** depth) + ((1 - p) / p) * acc
+
+def latency_summary(results: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    out = {}
+    for stage in STAGES:
+        xs = [r["timings_ms"].get(stage) for r in results]
+        xs = np.array([x for x in xs if x is not None], dtype="float64")
+        if xs.size == 0:
+            continue
+        out[stage] = {
+            "p50": round(float(np.percentile(xs, 50)), 3),
+            "p90": round(float(np.percentile(xs, 90)), 3),
+            "p99": round(float(np.percentile(xs, 99)), 3),
+            "max": round(float(xs.max()), 3),
+            "mean": round(float(xs.mean()), 3),
+        }
+    return out
+
+def ranking_diff(a: List[Dict[str, Any]], b: List[Dict[str, Any]], k: int, p: float,
+                 key: str = "ranking") -> Dict[str, Any]:
+    """
+    key: "ranking"(결정적 순위) 또는 "seqs"(실제 응답)
+    """
+    overlaps, rbos, changed = [], [], []
+    for ra, rb in zip(a, b):
+        xa, xb = ra[key][:k], rb[key][:k]
+        ov = overlap_at_k(xa, xb, k)
+        rbo = rank_biased_overlap(xa, xb, p)
+        overlaps.append(ov)
+        rbos.append(rbo)
+        if xa != xb:
+            changed.append({"query": ra["query"], "a": xa, "b": xb, "rbo": round(rbo, 4)})
+
+    changed.sort(key=lambda x: x["rbo"])
+    return {
+        "queries": len(overlaps),
+        "k": k,
+        "rbo_p": p,
+        f"mean_overlap@{k}": round(float(np.mean(overlaps)), 4) if overlaps else None,
+        "mean_rbo": round(float(np.mean(rbos)), 4) if rbos else None,
+        "changed": len(changed),
+        "worst": changed[:10],
+    }
+
+# =========================================================
+# 4) CLI
+# =========================================================
+def print_latency(title: str, summary: Dict[str, Dict[str, float]]):
+    print(f"\n[{title}] latency (ms)")
+    print(f"  {'stage':<16}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}{'mean':>10}")
+    for stage, v in summary.items():
+        print(f"  {stage:<16}{v['p50']:>10}{v['p90']:>10}{v['p99']:>10}{v['max']:>10}{v['mean']:>10}")
+
+def print_diff(title: str, diff: Dict[str, Any], label: str = "ranking diff"):
+    k = diff["k"]
+    print(f"\n[{title}] {label}")
+    print(f"  queries={diff['queries']}  overlap@{k}={diff[f'mean_overlap@{k}']}  "
+          f"rbo(p={diff['rbo_p']})={diff['mean_rbo']}  changed={diff['changed']}")
+    for w in diff["worst"]:
+        print(f"  - rbo={w['rbo']:<7} {w['query']!r}  {w['a']} -> {w['b']}")
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="쿼리 로그 리플레이 (지연시간/랭킹 회귀 확인)")
+    ap.add_argument("--log", required=True, help="쿼리 로그 JSONL 경로")
+    ap.add_argument("--artifacts", default=None, help="아티팩트 디렉터리 (기본: main.ART_DIR)")
+    ap.add_argument("--config", default=None, help="설정 A (JSON, 없으면 현재 환경변수 설정)")
+    ap.add_argument("--compare", default=None, help="설정 B (JSON). 없으면 로그의 실제 응답과 비교")
+    ap.add_argument("--k", type=int, default=10, help="ranking 비교 깊이 (기본 10)")
+    ap.add_argument("--top-k", type=int, default=None, help="served 추천 개수 (기본: 로그의 top_k)")
+    ap.add_argument("--rbo-p", type=float, default=0.9, help="RBO persistence p (기본 0.9)")
+    ap.add_argument("--limit", type=int, default=None, help="앞에서부터 N개 쿼리만 사용")
+    ap.add_argument("--json", action="store_true", help="결과를 JSON으로 출력")
+    args = ap.parse_args(argv)
+
+    rows = load_query_log(args.log, limit=args.limit)
+    if not rows:
+        print("쿼리 로그가 비어 있어요.", file=sys.stderr)
+        return 1
+
+    cfg_a = load_config(args.config)
+    cfg_b = load_config(args.compare) if args.compare else None
+    load_artifacts(args.artifacts)
+
+    res_a = replay(rows, cfg_a, k=args.top_k)
+    if cfg_b is not None:
+        res_b = replay(rows, cfg_b, k=args.top_k)
+        label_b = "B"
+    else:
+        res_b = [{
+            "query": r.get("query", ""),
+            "ranking": [str(x) for x in r.get("ranking", [])],
+            "seqs": [str(x) for x in r.get("seqs", [])],
+        } for r in rows]
+        label_b = "logged"
+
+    served_k = args.top_k or max(len(r["seqs"]) for r in res_a + res_b) or 1
+    report = {
+        "latency": {"A": latency_summary(res_a)},
+        "diff": ranking_diff(res_a, res_b, k=args.k, p=args.rbo_p),
+        "served_diff": ranking_diff(res_a, res_b, k=served_k, p=args.rbo_p, key="seqs"),
+    }
+    if cfg_b is not None:
+        report["latency"]["B"] = latency_summary(res_b)
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return 0
+
+    for name, summary in report["latency"].items():
+        print_latency(name, summary)
+    print_diff(f"A vs {label_b}", report["diff"])
+    print_diff(f"A vs {label_b}, served", report["served_diff"], label="served diff (가중 랜덤 선택 포함)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())